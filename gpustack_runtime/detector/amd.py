@@ -115,7 +115,6 @@ class AMDDetector(Detector):
                             dev_card_id,
                         )
                         dev_gpudev_info = pyamdgpu.amdgpu_query_gpu_info(dev_gpudev)
-                        pyamdgpu.amdgpu_device_deinitialize(dev_gpudev)
 
                 dev_gpu_driver_info = pyamdsmi.amdsmi_get_gpu_driver_info(dev)
                 dev_driver_ver = dev_gpu_driver_info.get("driver_version")
@@ -201,7 +200,7 @@ class AMDDetector(Detector):
 
 
 def _get_arch_family(
-    dev_gpudev_info: pyamdgpu.c_amdgpu_gpu_info | None,
+    dev_gpudev_info: pyamdgpu.amdgpuFriendlyObject | None,
 ) -> str | None:
     if not dev_gpudev_info:
         return None
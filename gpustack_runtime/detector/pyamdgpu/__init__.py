@@ -3,11 +3,16 @@
 ##
 from __future__ import annotations
 
+import atexit
+import contextlib
 import errno
 import os
+import struct as _struct
 import sys
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from ctypes import *
+from keyword import iskeyword
 from typing import ClassVar
 
 ## C Type mappings ##
@@ -39,8 +44,26 @@ AMDGPU_ERROR_LIBRARY_NOT_FOUND = -99999
 
 ## Lib loading ##
 amdgpuLib = None
+# Serializes _LoadAMDGPULibrary, callers check amdgpuLib before taking it.
 libLoadLock = threading.Lock()
 
+## Resolved function pointers ##
+# Populated once by _LoadAMDGPULibrary, called directly by the wrappers.
+_fn_amdgpu_device_initialize = None
+_fn_amdgpu_device_deinitialize = None
+_fn_amdgpu_query_gpu_info = None
+
+## Device cache ##
+# Initialized devices keyed by card index,
+# as [major, minor, device, fd, references].
+_device_cache: dict[int, list] = {}
+_device_cache_locks: dict[int, threading.Lock] = {}
+# Reusable gpu info buffers keyed by device handle address.
+_info_buffer: dict[int, c_amdgpu_gpu_info] = {}
+_info_buffer_locks: dict[int, threading.Lock] = {}
+# Static gpu info snapshots keyed by device handle address.
+_info_cache: dict[int, amdgpuFriendlyObject] = {}
+
 
 class AMDGPUError(Exception):
     _extend_errcode_to_string: ClassVar[dict[int, str]] = {
@@ -50,16 +73,17 @@ class AMDGPUError(Exception):
     }
 
     def __init__(self, value):
-        self.value = (
-            -value if value not in AMDGPUError._extend_errcode_to_string else value
+        msg = self._extend_errcode_to_string.get(value)
+        if msg is None:
+            value = -value
+            msg = errno.errorcode.get(value)
+        self.value = value
+        self._msg = (
+            f"AMDGPU error {value}: {msg}" if msg else f"Unknown AMDGPU error {value}"
         )
 
     def __str__(self):
-        if self.value in AMDGPUError._extend_errcode_to_string:
-            return f"AMDGPU error {self.value}: {AMDGPUError._extend_errcode_to_string[self.value]}"
-        if self.value not in errno.errorcode:
-            return f"Unknown AMDGPU error {self.value}"
-        return f"AMDGPU error {self.value}: {errno.errorcode[self.value]}"
+        return self._msg
 
     def __eq__(self, other):
         if isinstance(other, AMDGPUError):
@@ -75,51 +99,134 @@ def _amdgpuCheckReturn(ret):
     return ret
 
 
-## Function access ##
-_amdgpuGetFunctionPointer_cache = {}
-
-
-def _amdgpuGetFunctionPointer(name):
-    global amdgpuLib
-
-    if name in _amdgpuGetFunctionPointer_cache:
-        return _amdgpuGetFunctionPointer_cache[name]
-
-    libLoadLock.acquire()
-    try:
-        if amdgpuLib is None:
-            raise AMDGPUError(AMDGPU_ERROR_UNINITIALIZED)
-        try:
-            _amdgpuGetFunctionPointer_cache[name] = getattr(amdgpuLib, name)
-            return _amdgpuGetFunctionPointer_cache[name]
-        except AttributeError:
-            raise AMDGPUError(AMDGPU_ERROR_FUNCTION_NOT_FOUND)
-    finally:
-        libLoadLock.release()
-
-
 ## Alternative object
 # Allows the object to be printed
 # Allows mismatched types to be assigned
 #  - like None when the Structure variant requires c_uint
 class amdgpuFriendlyObject:
     def __init__(self, dictionary):
-        for x in dictionary:
-            setattr(self, x, dictionary[x])
+        self.__dict__.update(dictionary)
 
     def __str__(self):
         return self.__dict__.__str__()
 
 
+# Numeric ctypes codes that the struct module lays out the same way.
+_amdgpuStructUnpackableCodes = frozenset("bBhHiIlLqQfd?")
+# Attribute that maps a ctypes type to its host byte order variant.
+_amdgpuNativeOrderAttr = "__ctype_le__" if sys.byteorder == "little" else "__ctype_be__"
+
+
+def _amdgpuFieldShape(ctype):
+    shape = []
+    while hasattr(ctype, "_length_"):
+        shape.append(ctype._length_)
+        ctype = ctype._type_
+    return tuple(shape), getattr(ctype, "_type_", None)
+
+
+def _amdgpuIsNativeOrder(ctype):
+    while hasattr(ctype, "_length_"):
+        ctype = ctype._type_
+    return getattr(ctype, _amdgpuNativeOrderAttr, ctype) is ctype
+
+
+def _amdgpuMakeStructUnpacker(cls):
+    # Describe the whole Structure as a single struct.Struct,
+    # so that converting it is one unpack instead of a getattr per field.
+    # Returns None if any field cannot be described this way.
+    fmt = "@"
+    layout = []
+    for key, ctype, *bits in cls._fields_:
+        # Bitfields share an offset with their neighbours.
+        if bits:
+            return None
+        shape, code = _amdgpuFieldShape(ctype)
+        if not isinstance(code, str) or code not in _amdgpuStructUnpackableCodes:
+            return None
+        # Fields of a Big/LittleEndianStructure may be byte swapped.
+        if not _amdgpuIsNativeOrder(ctype):
+            return None
+        if _struct.calcsize(f"{fmt}0{code}") != getattr(cls, key).offset:
+            return None
+        count = 1
+        for n in shape:
+            count *= n
+        fmt += f"{count}{code}"
+        layout.append((key, count, shape))
+    unpacker = _struct.Struct(fmt)
+    if unpacker.size > sizeof(cls):
+        return None
+    return unpacker, layout
+
+
+def _amdgpuEmitReshape(start, shape):
+    if len(shape) == 1:
+        return f"list(v[{start}:{start + shape[0]}])"
+    step = 1
+    for n in shape[1:]:
+        step *= n
+    return (
+        "["
+        + ", ".join(
+            _amdgpuEmitReshape(start + i * step, shape[1:]) for i in range(shape[0])
+        )
+        + "]"
+    )
+
+
+def _amdgpuEmitListify(value, depth):
+    if depth == 1:
+        return f"list({value})"
+    item = f"r{depth}"
+    return f"[{_amdgpuEmitListify(item, depth - 1)} for {item} in {value}]"
+
+
+def _amdgpuMakeStructConverter(cls):
+    # Generate a converter specialized to the fields of cls,
+    # so that converting runs straight-line code instead of looping over _fields_.
+    namespace = {}
+    items = []
+    unpack = _amdgpuMakeStructUnpacker(cls)
+    if unpack is not None:
+        unpacker, layout = unpack
+        namespace["_unpack_from"] = unpacker.unpack_from
+        i = 0
+        for key, count, shape in layout:
+            value = _amdgpuEmitReshape(i, shape) if shape else f"v[{i}]"
+            items.append(f"{key!r}: {value}")
+            i += count
+        body = "    v = _unpack_from(s)\n"
+    else:
+        namespace["_decode"] = lambda v: v.decode() if isinstance(v, bytes) else v
+        for key, ctype, *_ in cls._fields_:
+            shape, code = _amdgpuFieldShape(ctype)
+            if key.isidentifier() and not iskeyword(key):
+                value = f"s.{key}"
+            else:
+                value = f"getattr(s, {key!r})"
+            # only need to convert from bytes if bytes, no need to check python version.
+            if code == "c" and len(shape) <= 1:
+                value = f"{value}.decode()"
+            elif code == "z" and not shape:
+                value = f"_decode({value})"
+            # copy numeric arrays out, the same shape as the unpack path.
+            elif shape and code in _amdgpuStructUnpackableCodes:
+                value = _amdgpuEmitListify(value, len(shape))
+            items.append(f"{key!r}: {value}")
+        body = ""
+    source = f"def convert(s):\n{body}    return {{{', '.join(items)}}}\n"
+    exec(source, namespace)
+    return namespace["convert"]
+
+
 def amdgpuStructToFriendlyObject(struct):
-    d = {}
-    for x in struct._fields_:
-        key = x[0]
-        value = getattr(struct, key)
-        # only need to convert from bytes if bytes, no need to check python version.
-        d[key] = value.decode() if isinstance(value, bytes) else value
-    obj = amdgpuFriendlyObject(d)
-    return obj
+    cls = type(struct)
+    convert = cls.__dict__.get("_to_friendly")
+    if convert is None:
+        convert = _amdgpuMakeStructConverter(cls)
+        cls._to_friendly = convert
+    return amdgpuFriendlyObject(convert(struct))
 
 
 # pack the object so it can be passed to the AMDGPU library
@@ -145,6 +252,8 @@ class _PrintableStructure(Structure):
         for x in self._fields_:
             key = x[0]
             value = getattr(self, key)
+            if isinstance(value, bytes):
+                value = value.decode()
             fmt = "%s"
             if key in self._fmt_:
                 fmt = self._fmt_[key]
@@ -153,8 +262,15 @@ class _PrintableStructure(Structure):
             result.append(("%s: " + fmt) % (key, value))
         return self.__class__.__name__ + "(" + ", ".join(result) + ")"
 
-    def __getattribute__(self, name):
-        res = super().__getattribute__(name)
+
+class _BytesCoercingStructure(_PrintableStructure):
+    """
+    Abstract class for structures with string fields,
+    which encodes str on assignment and decodes bytes on request.
+    """
+
+    def get_str(self, name):
+        res = getattr(self, name)
         if isinstance(res, bytes):
             return res.decode()
         return res
@@ -211,57 +327,221 @@ class c_amdgpu_gpu_info(_PrintableStructure):
 
 def _LoadAMDGPULibrary():
     global amdgpuLib
-    if amdgpuLib is None:
-        libLoadLock.acquire()
-        try:
-            if amdgpuLib is None:
-                if sys.platform.startswith("win"):
-                    # Do not support Windows yet.
-                    raise AMDGPUError(AMDGPU_ERROR_LIBRARY_NOT_FOUND)
-                # Linux path
-                locs = [
-                    "libdrm_amdgpu.so.1.0.0",
-                    "libdrm_amdgpu.so",
-                ]
-                for loc in locs:
-                    try:
-                        amdgpuLib = CDLL(loc)
-                        break
-                    except OSError:
-                        pass
-                if amdgpuLib is None:
-                    raise AMDGPUError(AMDGPU_ERROR_LIBRARY_NOT_FOUND)
-        finally:
-            libLoadLock.release()
+    with libLoadLock:
+        if amdgpuLib is not None:
+            return
+        if sys.platform.startswith("win"):
+            # Do not support Windows yet.
+            raise AMDGPUError(AMDGPU_ERROR_LIBRARY_NOT_FOUND)
+        # Linux path
+        locs = [
+            "libdrm_amdgpu.so.1.0.0",
+            "libdrm_amdgpu.so",
+        ]
+        for loc in locs:
+            try:
+                amdgpuLib = CDLL(loc)
+                break
+            except OSError:
+                pass
+        if amdgpuLib is None:
+            raise AMDGPUError(AMDGPU_ERROR_LIBRARY_NOT_FOUND)
+        _amdgpuResolveFunctionPointers()
+
+
+def _amdgpuResolveFunctionPointer(name, argtypes, restype=c_int):
+    fn = getattr(amdgpuLib, name, None)
+    if fn is not None:
+        fn.argtypes = argtypes
+        fn.restype = restype
+    return fn
+
+
+def _amdgpuResolveFunctionPointers():
+    global _fn_amdgpu_device_initialize
+    global _fn_amdgpu_device_deinitialize
+    global _fn_amdgpu_query_gpu_info
+
+    _fn_amdgpu_device_initialize = _amdgpuResolveFunctionPointer(
+        "amdgpu_device_initialize",
+        [c_int, POINTER(c_uint32), POINTER(c_uint32), POINTER(c_amdgpu_device_t)],
+    )
+    _fn_amdgpu_device_deinitialize = _amdgpuResolveFunctionPointer(
+        "amdgpu_device_deinitialize",
+        [c_amdgpu_device_t],
+    )
+    _fn_amdgpu_query_gpu_info = _amdgpuResolveFunctionPointer(
+        "amdgpu_query_gpu_info",
+        [c_amdgpu_device_t, POINTER(c_amdgpu_gpu_info)],
+    )
+
+
+def _amdgpuCheckFunctionPointer(fn):
+    if fn is None:
+        if amdgpuLib is None:
+            raise AMDGPUError(AMDGPU_ERROR_UNINITIALIZED)
+        raise AMDGPUError(AMDGPU_ERROR_FUNCTION_NOT_FOUND)
+    return fn
 
 
 ## C function wrappers ##
+# Errors that mean a card node is absent or not driven by amdgpu,
+# libdrm rejects other DRM drivers with EBADF.
+_amdgpuNoDeviceErrors = frozenset((errno.ENOENT, errno.ENODEV, errno.EBADF))
+
+
+def _amdgpuGetDeviceLock(card):
+    return _device_cache_locks.setdefault(card, threading.Lock())
+
+
 def amdgpu_device_initialize(card=1):
-    _LoadAMDGPULibrary()
-
-    fd = os.open(f"/dev/dri/card{card}", os.O_RDONLY)
-    c_major = c_uint32()
-    c_minor = c_uint32()
-    device = c_amdgpu_device_t()
-    fn = _amdgpuGetFunctionPointer("amdgpu_device_initialize")
-    # If receive an error print here, try
-    # sudo vim /etc/default/grub
-    # and add "amdgpu.dc=0" to GRUB_CMDLINE_LINUX_DEFAULT
-    # then run "sudo update-grub" and reboot.
-    ret = fn(fd, byref(c_major), byref(c_minor), byref(device))
-    _amdgpuCheckReturn(ret)
-    return c_major.value, c_minor.value, device
+    with _amdgpuGetDeviceLock(card):
+        entry = _device_cache.get(card)
+        if entry is not None:
+            entry[4] += 1
+            return entry[0], entry[1], entry[2]
 
+        if amdgpuLib is None:
+            _LoadAMDGPULibrary()
+        fn = _amdgpuCheckFunctionPointer(_fn_amdgpu_device_initialize)
 
-def amdgpu_device_deinitialize(device):
-    fn = _amdgpuGetFunctionPointer("amdgpu_device_deinitialize")
-    ret = fn(device)
+        try:
+            fd = os.open(f"/dev/dri/card{card}", os.O_RDONLY | os.O_CLOEXEC)
+        except OSError as e:
+            raise AMDGPUError(-e.errno) from e
+        c_major = c_uint32()
+        c_minor = c_uint32()
+        device = c_amdgpu_device_t()
+        # If receive an error print here, try
+        # sudo vim /etc/default/grub
+        # and add "amdgpu.dc=0" to GRUB_CMDLINE_LINUX_DEFAULT
+        # then run "sudo update-grub" and reboot.
+        try:
+            ret = fn(fd, byref(c_major), byref(c_minor), byref(device))
+            _amdgpuCheckReturn(ret)
+        except AMDGPUError:
+            os.close(fd)
+            raise
+        _device_cache[card] = [c_major.value, c_minor.value, device, fd, 1]
+        # GPU info is static, fetch it once while opening.
+        with contextlib.suppress(AMDGPUError):
+            amdgpu_query_gpu_info(device)
+        return c_major.value, c_minor.value, device
+
+
+# Tear down a cached device regardless of how many callers still hold it.
+def amdgpu_device_release(card=1):
+    with _amdgpuGetDeviceLock(card):
+        entry = _device_cache.pop(card, None)
+        if entry is None:
+            return
+        _amdgpuDeviceDeinitialize(entry[2], entry[3])
+
+
+@atexit.register
+def _amdgpuReleaseDevices():
+    for card in list(_device_cache):
+        with contextlib.suppress(AMDGPUError, OSError):
+            amdgpu_device_release(card)
+
+
+# Every returned device holds a reference like amdgpu_device_initialize,
+# cards stay initialized and cached until each is deinitialized,
+# amdgpu_device_release is called or the process exits.
+def amdgpu_enumerate_devices(max_cards=8):
+    if amdgpuLib is None:
+        _LoadAMDGPULibrary()
+
+    def _try_init(card):
+        try:
+            _, _, device = amdgpu_device_initialize(card)
+        except AMDGPUError as e:
+            if e.value in _amdgpuNoDeviceErrors:
+                return None
+            raise
+        return card, device
+
+    results = []
+    uncached = []
+    for card in range(max_cards):
+        if card in _device_cache:
+            # Cache hit, only takes a reference.
+            result = _try_init(card)
+            if result:
+                results.append(result)
+        else:
+            uncached.append(card)
+    if uncached:
+        # Opening a card blocks in the kernel with the GIL released,
+        # so probe the uncached cards concurrently.
+        with ThreadPoolExecutor(max_workers=min(8, len(uncached))) as executor:
+            results.extend(r for r in executor.map(_try_init, uncached) if r)
+    results.sort(key=lambda r: r[0])
+    return results
+
+
+def _amdgpuDeviceKey(device):
+    return cast(device, c_void_p).value
+
+
+def _amdgpuDeviceDeinitialize(device, fd):
+    key = _amdgpuDeviceKey(device)
+    _info_buffer.pop(key, None)
+    _info_buffer_locks.pop(key, None)
+    _info_cache.pop(key, None)
+    try:
+        fn = _amdgpuCheckFunctionPointer(_fn_amdgpu_device_deinitialize)
+        ret = fn(device)
+    finally:
+        if fd is not None:
+            os.close(fd)
     _amdgpuCheckReturn(ret)
 
 
-def amdgpu_query_gpu_info(device):
-    c_info = c_amdgpu_gpu_info()
-    fn = _amdgpuGetFunctionPointer("amdgpu_query_gpu_info")
+def amdgpu_device_deinitialize(device):
+    # Cached devices drop one reference,
+    # the last one also drops the cache entry and closes the card fd.
+    key = _amdgpuDeviceKey(device)
+    for card, entry in list(_device_cache.items()):
+        if _amdgpuDeviceKey(entry[2]) != key:
+            continue
+        with _amdgpuGetDeviceLock(card):
+            if _device_cache.get(card) is not entry:
+                # Already released.
+                return
+            entry[4] -= 1
+            if entry[4] > 0:
+                return
+            del _device_cache[card]
+            _amdgpuDeviceDeinitialize(entry[2], entry[3])
+        return
+    _amdgpuDeviceDeinitialize(device, None)
+
+
+def _amdgpuQueryGpuInfo(device, c_info):
+    fn = _amdgpuCheckFunctionPointer(_fn_amdgpu_query_gpu_info)
     ret = fn(device, byref(c_info))
     _amdgpuCheckReturn(ret)
     return c_info
+
+
+def amdgpu_query_gpu_info(device):
+    info = _info_cache.get(_amdgpuDeviceKey(device))
+    if info is None:
+        info = amdgpu_query_gpu_info_fresh(device)
+    return info
+
+
+def amdgpu_query_gpu_info_fresh(device):
+    key = _amdgpuDeviceKey(device)
+    # Fill and snapshot the shared buffer under its lock,
+    # so a concurrent query cannot clear it before the snapshot is taken.
+    with _info_buffer_locks.setdefault(key, threading.Lock()):
+        c_info = _info_buffer.get(key)
+        if c_info is None:
+            c_info = _info_buffer[key] = c_amdgpu_gpu_info()
+        else:
+            memset(addressof(c_info), 0, sizeof(c_info))
+        _amdgpuQueryGpuInfo(device, c_info)
+        info = _info_cache[key] = amdgpuStructToFriendlyObject(c_info)
+    return info
@@ -0,0 +1,281 @@
+import errno
+import os
+import random
+import types
+from ctypes import (
+    POINTER,
+    BigEndianStructure,
+    Structure,
+    c_char,
+    c_char_p,
+    c_int,
+    c_ubyte,
+    c_uint,
+    c_void_p,
+    cast,
+    sizeof,
+)
+
+import pytest
+
+from gpustack_runtime.detector import pyamdgpu
+
+
+def _expected(struct):
+    def convert(value):
+        if isinstance(value, bytes):
+            return value.decode()
+        return value
+
+    return {x[0]: convert(getattr(struct, x[0])) for x in struct._fields_}
+
+
+def _listify(value):
+    if hasattr(value, "_length_"):
+        return [_listify(v) for v in value]
+    return value
+
+
+def test_struct_to_friendly_object_gpu_info():
+    info = pyamdgpu.c_amdgpu_gpu_info()
+    buf = (c_ubyte * sizeof(info)).from_buffer(info)
+    rng = random.Random(0)
+    for i in range(len(buf)):
+        buf[i] = rng.randrange(256)
+
+    actual = pyamdgpu.amdgpuStructToFriendlyObject(info).__dict__
+    expected = {k: _listify(v) for k, v in _expected(info).items()}
+    assert actual == expected
+
+
+def test_struct_to_friendly_object_fallback():
+    class Mixed(Structure):
+        _fields_ = [
+            ("name", c_char * 8),
+            ("path", c_char_p),
+            ("flag", c_char),
+            ("count", c_uint * 2),
+            ("class", c_int),
+        ]
+
+    struct = Mixed(b"amdgpu", b"/dev/dri", b"y", (c_uint * 2)(1, 2), 5)
+    actual = pyamdgpu.amdgpuStructToFriendlyObject(struct).__dict__
+    assert actual == {
+        "name": "amdgpu",
+        "path": "/dev/dri",
+        "flag": "y",
+        "count": [1, 2],
+        "class": 5,
+    }
+
+    struct = Mixed()
+    actual = pyamdgpu.amdgpuStructToFriendlyObject(struct).__dict__
+    assert actual["path"] is None
+
+
+def test_struct_to_friendly_object_bitfields():
+    class Bits(Structure):
+        _fields_ = [
+            ("low", c_uint, 4),
+            ("high", c_uint, 28),
+            ("next", c_uint),
+        ]
+
+    struct = Bits(3, 7, 9)
+    actual = pyamdgpu.amdgpuStructToFriendlyObject(struct).__dict__
+    assert actual == _expected(struct)
+
+
+def test_struct_to_friendly_object_big_endian():
+    class Swapped(BigEndianStructure):
+        _fields_ = [
+            ("value", c_uint),
+            ("matrix", (c_uint * 2) * 2),
+        ]
+
+    struct = Swapped(1)
+    struct.matrix[0][1] = 2
+    struct.matrix[1][0] = 3
+    actual = pyamdgpu.amdgpuStructToFriendlyObject(struct).__dict__
+    assert actual == {"value": 1, "matrix": [[0, 2], [3, 0]]}
+
+
+class _FakeAMDGPU:
+    """
+    Stands in for libdrm_amdgpu and /dev/dri, cards 1 and 3 are amdgpu,
+    card 2 belongs to another DRM driver and card 4 is not accessible.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.opened = {}
+        self.closed = []
+        self._handles = iter(range(0x1000, 0x100000, 0x10))
+
+    def open(self, path, flags):
+        card = int(path.rsplit("card", 1)[1])
+        if card == 4:
+            raise PermissionError(errno.EACCES, os.strerror(errno.EACCES), path)
+        if card not in (1, 2, 3):
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        fd = os.open(os.devnull, flags)
+        self.opened[fd] = card
+        return fd
+
+    def close(self, fd):
+        self.closed.append(fd)
+        os.close(fd)
+
+    def device_initialize(self, fd, _major, _minor, device):
+        self.calls.append("initialize")
+        if self.opened[fd] == 2:
+            return -errno.EBADF
+        cast(device, POINTER(c_void_p)).contents.value = next(self._handles)
+        return 0
+
+    def device_deinitialize(self, _device):
+        self.calls.append("deinitialize")
+        return 0
+
+    def query_gpu_info(self, _device, info):
+        self.calls.append("query")
+        info = cast(info, POINTER(pyamdgpu.c_amdgpu_gpu_info)).contents
+        info.family_id = pyamdgpu.AMDGPU_FAMILY_NV
+        return 0
+
+
+@pytest.fixture
+def fake_amdgpu(monkeypatch):
+    fake = _FakeAMDGPU()
+    fake_os = types.SimpleNamespace(
+        open=fake.open,
+        close=fake.close,
+        O_RDONLY=os.O_RDONLY,
+        O_CLOEXEC=os.O_CLOEXEC,
+    )
+    monkeypatch.setattr(pyamdgpu, "os", fake_os)
+    monkeypatch.setattr(pyamdgpu, "amdgpuLib", object())
+    monkeypatch.setattr(
+        pyamdgpu,
+        "_fn_amdgpu_device_initialize",
+        fake.device_initialize,
+    )
+    monkeypatch.setattr(
+        pyamdgpu,
+        "_fn_amdgpu_device_deinitialize",
+        fake.device_deinitialize,
+    )
+    monkeypatch.setattr(pyamdgpu, "_fn_amdgpu_query_gpu_info", fake.query_gpu_info)
+    for name in (
+        "_device_cache",
+        "_device_cache_locks",
+        "_info_buffer",
+        "_info_buffer_locks",
+        "_info_cache",
+    ):
+        monkeypatch.setattr(pyamdgpu, name, {})
+    return fake
+
+
+def test_device_initialize_cached(fake_amdgpu):
+    _, _, device = pyamdgpu.amdgpu_device_initialize(1)
+    _, _, again = pyamdgpu.amdgpu_device_initialize(1)
+
+    assert again is device
+    assert len(fake_amdgpu.opened) == 1
+    assert fake_amdgpu.calls == ["initialize", "query"]
+
+
+def test_device_initialize_failure_closes_fd(fake_amdgpu):
+    with pytest.raises(pyamdgpu.AMDGPUError) as e:
+        pyamdgpu.amdgpu_device_initialize(2)
+
+    assert e.value == errno.EBADF
+    assert fake_amdgpu.closed == list(fake_amdgpu.opened)
+    assert 2 not in pyamdgpu._device_cache  # noqa: SLF001
+
+    with pytest.raises(pyamdgpu.AMDGPUError) as e:
+        pyamdgpu.amdgpu_device_initialize(5)
+
+    assert e.value == errno.ENOENT
+
+
+def test_device_deinitialize_closes_fd(fake_amdgpu):
+    _, _, device = pyamdgpu.amdgpu_device_initialize(1)
+    info = pyamdgpu.amdgpu_query_gpu_info_fresh(device)
+    assert info.family_id == pyamdgpu.AMDGPU_FAMILY_NV
+    assert pyamdgpu.amdgpu_query_gpu_info(device) is info
+
+    pyamdgpu.amdgpu_device_deinitialize(device)
+
+    assert fake_amdgpu.calls[-1] == "deinitialize"
+    assert fake_amdgpu.closed == list(fake_amdgpu.opened)
+    assert not pyamdgpu._device_cache  # noqa: SLF001
+    assert not pyamdgpu._info_cache  # noqa: SLF001
+    assert not pyamdgpu._info_buffer  # noqa: SLF001
+
+
+def test_device_deinitialize_shared_handle(fake_amdgpu):
+    _, _, first = pyamdgpu.amdgpu_device_initialize(1)
+    _, _, second = pyamdgpu.amdgpu_device_initialize(1)
+
+    pyamdgpu.amdgpu_device_deinitialize(second)
+
+    assert "deinitialize" not in fake_amdgpu.calls
+    assert not fake_amdgpu.closed
+    info = pyamdgpu.amdgpu_query_gpu_info_fresh(first)
+    assert info.family_id == pyamdgpu.AMDGPU_FAMILY_NV
+
+    pyamdgpu.amdgpu_device_deinitialize(first)
+
+    assert fake_amdgpu.calls.count("deinitialize") == 1
+    assert fake_amdgpu.closed == list(fake_amdgpu.opened)
+
+
+def test_device_release(fake_amdgpu):
+    pyamdgpu.amdgpu_device_initialize(1)
+    pyamdgpu.amdgpu_device_initialize(1)
+
+    pyamdgpu.amdgpu_device_release(1)
+
+    assert fake_amdgpu.calls.count("deinitialize") == 1
+    assert fake_amdgpu.closed == list(fake_amdgpu.opened)
+    assert not pyamdgpu._device_cache  # noqa: SLF001
+
+
+def test_enumerate_devices(fake_amdgpu):
+    _, _, cached = pyamdgpu.amdgpu_device_initialize(3)
+
+    devices = pyamdgpu.amdgpu_enumerate_devices(max_cards=4)
+
+    assert [card for card, _ in devices] == [1, 3]
+    assert devices[1][1] is cached
+    assert sorted(fake_amdgpu.opened.values()) == [1, 2, 3]
+
+    assert pyamdgpu.amdgpu_enumerate_devices(max_cards=0) == []
+
+
+@pytest.mark.usefixtures("fake_amdgpu")
+def test_enumerate_devices_propagates_errors():
+    with pytest.raises(pyamdgpu.AMDGPUError) as e:
+        pyamdgpu.amdgpu_enumerate_devices(max_cards=5)
+
+    assert e.value == errno.EACCES
+
+
+@pytest.mark.parametrize(
+    "ret, value, message",
+    [
+        (-errno.EINVAL, errno.EINVAL, f"AMDGPU error {errno.EINVAL}: EINVAL"),
+        (
+            pyamdgpu.AMDGPU_ERROR_LIBRARY_NOT_FOUND,
+            pyamdgpu.AMDGPU_ERROR_LIBRARY_NOT_FOUND,
+            "AMDGPU error -99999: Library Not Found",
+        ),
+        (-5000, 5000, "Unknown AMDGPU error 5000"),
+    ],
+)
+def test_error_message(ret, value, message):
+    e = pyamdgpu.AMDGPUError(ret)
+    assert e == value
+    assert str(e) == message